@@ -8,11 +8,17 @@ components = ['XIP', 'YIP', 'XQD', 'YQD']
 dist_tol = 0.02
 dummy_val = 0.00001
 dummy_err = 9876
+# Site store layout: fixed-size header, frequency list, fixed-size station records, then a name-sorted index
+store_magic = b'ZTEMSTOR'
+store_header = '<8sIIQQ'
+store_name_len = 32
 
 from collections import OrderedDict
 import numpy as np
 import geosoft.gxpy as gxpy
 import os
+import struct
+import fnmatch
 from datetime import datetime
 import sys
 import pkg_resources
@@ -53,6 +59,74 @@ def rotate_data(data, theta):
             data['TZYI'][ii, ifreq] = dYI
     return data
 
+def along_track_distance(X, Y):
+    # Cumulative flight path length, measured between consecutive valid positions so that a gap
+    # in the positions (e.g., a GPS dropout) still counts towards the distance flown.
+    # Samples inside a gap are placed linearly between the valid positions either side.
+    X, Y = np.ravel(X), np.ravel(Y)
+    valid = ~(np.isnan(X) | np.isnan(Y))
+    if np.count_nonzero(valid) < 2:
+        return np.zeros(len(X))
+    seg = np.sqrt(np.diff(X[valid])**2 + np.diff(Y[valid])**2)
+    samples = np.arange(len(X))
+    return np.interp(samples, samples[valid], np.concatenate(([0], np.cumsum(seg))))
+
+def reuse_buffer(buffers, key, shape, dtype=float):
+    # View of a preallocated array that is kept between lines and only reallocated when a larger one is needed
+    size = int(np.prod(shape))
+    if key not in buffers or buffers[key].size < size or buffers[key].dtype != dtype:
+        buffers[key] = np.empty(size, dtype=dtype)
+    return buffers[key][:size].reshape(shape)
+
+def interp_rows(x, block, xi):
+    # Linear interpolation of every column of block (nsamples, nchannels) at once. x must be non-decreasing.
+    # Where one of the two neighbouring samples is a dummy (NaN) the other is used, so only
+    # points with dummies on both sides come out as NaN.
+    idx = np.clip(np.searchsorted(x, xi, side='right') - 1, 0, len(x) - 2)
+    seg = x[idx + 1] - x[idx]
+    w = np.clip(np.divide(xi - x[idx], seg, out=np.zeros(len(xi)), where=seg > 0), 0, 1)[:, None]
+    left, right = block[idx], block[idx + 1]
+    out = left * (1 - w) + right * w
+    np.copyto(out, right, where=np.isnan(left))
+    np.copyto(out, left, where=np.isnan(right))
+    return out
+
+def resample_line(dist, block, stations, window=0, buffers=None):
+    # Interpolate all channels in block (nsamples, nchannels) to the along-track station positions.
+    # If a window (in meters) is given, each station is instead the mean over [station - window/2, station + window/2].
+    # The mean is taken from running integrals of the whole block, so the cost does not depend on the window size.
+    # Dummy (NaN) samples are excluded from the mean, and a station with no valid samples in its window is NaN.
+    # The block-sized work arrays are taken from buffers (see reuse_buffer) when given.
+    if len(dist) < 2:
+        return np.full((len(stations), block.shape[1]), np.nan)
+    if not window:
+        return interp_rows(dist, block, stations)
+    if buffers is None:
+        buffers = {}
+    valid = reuse_buffer(buffers, 'valid', block.shape, dtype=bool)
+    np.isnan(block, out=valid)
+    np.logical_not(valid, out=valid)
+    seg = 0.5 * np.diff(dist)[:, None]
+    # Running trapezoid integrals of the values (dummies as 0) and of the valid sample mask
+    # int_valid first holds the values with dummies zeroed, until they have gone into int_values
+    int_values = reuse_buffer(buffers, 'int_values', block.shape)
+    int_valid = reuse_buffer(buffers, 'int_valid', block.shape)
+    int_valid[:] = 0
+    np.copyto(int_valid, block, where=valid)
+    np.add(int_valid[1:], int_valid[:-1], out=int_values[1:])
+    int_values[1:] *= seg
+    int_values[0] = 0
+    np.cumsum(int_values, axis=0, out=int_values)
+    np.add(valid[1:], valid[:-1], out=int_valid[1:], dtype=float)
+    int_valid[1:] *= seg
+    int_valid[0] = 0
+    np.cumsum(int_valid, axis=0, out=int_valid)
+    lo = np.clip(stations - window / 2, dist[0], dist[-1])
+    hi = np.clip(stations + window / 2, dist[0], dist[-1])
+    total = interp_rows(dist, int_values, hi) - interp_rows(dist, int_values, lo)
+    weight = interp_rows(dist, int_valid, hi) - interp_rows(dist, int_valid, lo)
+    return np.divide(total, weight, out=np.full(total.shape, np.nan), where=weight > 0)
+
 def to_edi(site, out_file, freqs, info=None, header=None, mtsect=None, defs=None):
     NP = len(freqs)
     lat_deg, lat_min, lat_sec = dd2dms(site['Latitude'])
@@ -232,7 +306,211 @@ def to_edi(site, out_file, freqs, info=None, header=None, mtsect=None, defs=None
         f.write('>END')
 
 
-def from_gdb(gdb_path, out_path, downsample_rate, skip_lines=True, rotation=0, write_edis=True):
+def store_dtype(nfreq):
+    # One fixed-size record per station, holding the values exactly as they are passed to to_edi
+    return np.dtype([('Name', 'S{}'.format(store_name_len)),
+                     ('Latitude', '<f8'),
+                     ('Longitude', '<f8'),
+                     ('TZXR', '<f8', (nfreq,)),
+                     ('TZYR', '<f8', (nfreq,)),
+                     ('TZXI', '<f8', (nfreq,)),
+                     ('TZYI', '<f8', (nfreq,))])
+
+def index_dtype():
+    return np.dtype([('Name', 'S{}'.format(store_name_len)), ('Offset', '<u8')])
+
+def store_records(names, nfreq):
+    # Preallocate a block of records for the given site names. Longer names would be silently truncated by numpy.
+    for name in names:
+        if len(name) > store_name_len:
+            raise ValueError('Site name {} is too long for the site store (max {} characters)'.format(name, store_name_len))
+    records = np.zeros(len(names), dtype=store_dtype(nfreq))
+    records['Name'] = names
+    return records
+
+def open_store(store_file, freqs):
+    # Header is written with zero sites for now and rewritten in close_store once the index is known
+    f = open(store_file, 'wb')
+    f.write(struct.pack(store_header, store_magic, len(freqs), store_name_len, 0, 0))
+    f.write(np.asarray(freqs, dtype='<f8').tobytes())
+    return f
+
+def write_store(f, records):
+    # Sequential append of a block of station records. Returns the byte offset of each record.
+    start = f.tell()
+    f.write(records.tobytes())
+    return start + np.arange(len(records), dtype='<u8') * records.dtype.itemsize
+
+def close_store(f, freqs, names, offsets):
+    index = np.zeros(len(names), dtype=index_dtype())
+    index['Name'] = names
+    index['Offset'] = offsets
+    index.sort(order='Name')
+    if np.any(index['Name'][1:] == index['Name'][:-1]):
+        print('Warning: Duplicate site names in the site store. Only one of each will be retrievable by name.')
+    index_offset = f.tell()
+    f.write(index.tobytes())
+    f.seek(0)
+    f.write(struct.pack(store_header, store_magic, len(freqs), store_name_len, len(index), index_offset))
+    f.close()
+
+def read_store(store_file):
+    # Memory-maps the store. Nothing is read from disk until a record is accessed.
+    with open(store_file, 'rb') as f:
+        magic, nfreq, name_len, nsites, index_offset = struct.unpack(store_header,
+                                                                     f.read(struct.calcsize(store_header)))
+        if magic != store_magic or name_len != store_name_len:
+            raise ValueError('{} is not a ztem2edi site store'.format(store_file))
+        freqs = np.frombuffer(f.read(8 * nfreq), dtype='<f8')
+    if nsites == 0:
+        return freqs, np.zeros(0, dtype=store_dtype(nfreq)), np.zeros(0, dtype=index_dtype())
+    data_offset = struct.calcsize(store_header) + 8 * nfreq
+    records = np.memmap(store_file, dtype=store_dtype(nfreq), mode='r', offset=data_offset, shape=(nsites,))
+    index = np.memmap(store_file, dtype=index_dtype(), mode='r', offset=index_offset, shape=(nsites,))
+    return freqs, records, index
+
+def store_site(store, name):
+    freqs, records, index = store
+    key = name.encode()
+    ii = np.searchsorted(index['Name'], key)
+    if ii == len(index) or index['Name'][ii] != key:
+        raise KeyError('Site {} not found in the site store'.format(name))
+    data_offset = struct.calcsize(store_header) + 8 * len(freqs)
+    record = records[(int(index['Offset'][ii]) - data_offset) // records.dtype.itemsize]
+    return {'Name': name,
+            'TZXR': np.array(record['TZXR']),
+            'TZYR': np.array(record['TZYR']),
+            'TZXI': np.array(record['TZXI']),
+            'TZYI': np.array(record['TZYI']),
+            'Latitude': float(record['Latitude']),
+            'Longitude': float(record['Longitude'])}
+
+def from_store(store_file, out_path, site_names=None):
+    # Render EDIs on demand from a site store. Names may include shell-style wildcards, e.g., L1010_*
+    store = read_store(store_file)
+    all_names = [name.decode() for name in store[2]['Name']]
+    if not site_names:
+        selected = all_names
+    else:
+        # Resolve every name before writing anything so a typo doesn't leave a partial set of EDIs
+        known = set(all_names)
+        selected = []
+        for name in site_names:
+            if any(c in name for c in '*?['):
+                matches = fnmatch.filter(all_names, name)
+                if not matches:
+                    print('Warning: No sites in {} match {}'.format(store_file, name))
+                selected.extend(matches)
+            elif name in known:
+                selected.append(name)
+            else:
+                print('Warning: Site {} not found in {}. Skipping...'.format(name, store_file))
+    if not os.path.exists(out_path):
+        os.mkdir(out_path)
+    for name in selected:
+        site = store_site(store, name)
+        out_file = os.path.join(out_path, name + '.edi')
+        to_edi(site, out_file, freqs=store[0], info=None, header=None, mtsect=None, defs=None)
+    print('Wrote {} of {} EDIs from {}'.format(len(selected), len(all_names), store_file))
+
+
+def read_latlon(gdb, line):
+    try:
+        return (gdb.read_line(line, channels='Latitude')[0],
+                gdb.read_line(line, channels='Longitude')[0])
+    except gxpy.gdb.GdbException:
+        try:
+            return (gdb.read_line(line, channels='Lat')[0],
+                    gdb.read_line(line, channels='Long')[0])
+        except gxpy.gdb.GdbException:
+            return (gdb.read_line(line, channels='Lat')[0],
+                    gdb.read_line(line, channels='Lon')[0])
+
+
+def resample_chunked(dist, block, stations, window=0, chunk_size=None, out=None, buffers=None):
+    # Same result as resample_line, but the running integrals are only ever built over chunk_size samples at a time.
+    # Consecutive chunks overlap by the half window (plus a sample) so that every station sees its complete window.
+    if out is None:
+        out = np.empty((len(stations), block.shape[1]))
+    nsamples = len(dist)
+    if not chunk_size or chunk_size >= nsamples:
+        out[:] = resample_line(dist, block, stations, window=window, buffers=buffers)
+        return out
+    s0 = 0
+    while s0 < len(stations):
+        a = max(np.searchsorted(dist, stations[s0] - window / 2, side='right') - 1, 0)
+        # Extend the chunk if it is too short to hold the first station's window
+        b = max(a + chunk_size, np.searchsorted(dist, stations[s0] + window / 2, side='left') + 1)
+        b = min(b, nsamples)
+        if b == nsamples:
+            s1 = len(stations)
+        else:
+            s1 = max(np.searchsorted(stations, dist[b - 1] - window / 2, side='right'), s0 + 1)
+        out[s0:s1] = resample_line(dist[a:b], block[a:b], stations[s0:s1], window=window, buffers=buffers)
+        s0 = s1
+    return out
+
+def min_memory(nsamples):
+    # Smallest budget that holds one frequency (all components) of a line, plus the same again for resampling.
+    # Channels are read whole from the gdb, so the budget can't go below this.
+    return 2 * nsamples * len(components) * 8
+
+def read_resampled_line(gdb, line, freqs, dist, stations, window=0, memory=None, buffers=None):
+    # Reads the component / frequency channels of a line into one (nsamples, nchannels) block
+    # and resamples them all together onto the station positions.
+    # With a memory budget (in bytes), half of it goes to the raw channel block, which is then filled a few
+    # frequencies at a time, and the other half to the resampling work arrays, which are built in sample chunks.
+    convert = {'XIP': 'TZXR', 'YIP': 'TZYR', 'XQD': 'TZXI', 'YQD': 'TZYI'}
+    nfreq = len(freqs)
+    ncomp = len(components)
+    if buffers is None:
+        buffers = {}
+    # Positions are interpolated rather than averaged so that stations stay at their nominal locations.
+    # Only valid positions are used, so stations inside a GPS dropout are placed on the straight line across it.
+    lat, lon = read_latlon(gdb, line)
+    lat, lon = np.ravel(lat), np.ravel(lon)
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    if not np.any(valid):
+        print('Line {} has no valid Latitude / Longitude. Skipping its {} stations...'.format(line, len(stations)))
+        data = {convert[component]: np.zeros((0, nfreq)) for component in components}
+        data['Latitude'] = np.zeros((0, 1))
+        data['Longitude'] = np.zeros((0, 1))
+        return data
+    if memory:
+        group = int(np.clip(memory // min_memory(len(dist)), 1, nfreq))
+        # The windowed resampling holds two float arrays and a mask the size of its input chunk
+        chunk_size = max(int(memory / 2 // (ncomp * group * 17)), 2)
+    else:
+        group = nfreq
+        chunk_size = None
+    resampled = reuse_buffer(buffers, 'resampled', (len(stations), ncomp * nfreq))
+    for f0 in range(0, nfreq, group):
+        f1 = min(f0 + group, nfreq)
+        block = reuse_buffer(buffers, 'block', (len(dist), ncomp * (f1 - f0)))
+        for ii, freq in enumerate(freqs[f0:f1]):
+            for ic, component in enumerate(components):
+                channel = np.ravel(gdb.read_line(line, channels='{}_{:03d}Hz'.format(component, freq))[0])
+                if len(channel) != len(dist):
+                    print('{}_{:03d}Hz at line {} has {} samples, expected {}'.format(component, freq, line,
+                                                                                 len(channel), len(dist)))
+                    print('Infilling frequency {} with dummies'.format(freq))
+                    block[:, ii::f1 - f0] = 1e-10
+                    break
+                block[:, ic * (f1 - f0) + ii] = channel
+        out = resample_chunked(dist, block, stations, window=window, chunk_size=chunk_size,
+                               out=reuse_buffer(buffers, 'out', (len(stations), ncomp * (f1 - f0))),
+                               buffers=buffers)
+        for ic in range(ncomp):
+            resampled[:, ic * nfreq + f0:ic * nfreq + f1] = out[:, ic * (f1 - f0):(ic + 1) * (f1 - f0)]
+    # Copied out of the shared buffer, since rotation and the store / EDI writers work on these in place
+    data = {convert[component]: resampled[:, ic * nfreq:(ic + 1) * nfreq].copy() for ic, component in enumerate(components)}
+    data['Latitude'] = np.interp(stations, dist[valid], lat[valid])[:, None]
+    data['Longitude'] = np.interp(stations, dist[valid], lon[valid])[:, None]
+    return data
+
+
+def from_gdb(gdb_path, out_path, downsample_rate, skip_lines=True, rotation=0, write_edis=True, store_file=None,
+             interpolate=False, window=0, memory=None):
     convert = {'XIP': 'TZXR', 'YIP': 'TZYR', 'XQD': 'TZXI', 'YQD': 'TZYI'}
     data = {'TZXR': [], 'TZYR': [], 'TZXI': [], 'TZYI': [], 'Longitude': [], 'Latitude': []}
 
@@ -247,6 +525,15 @@ def from_gdb(gdb_path, out_path, downsample_rate, skip_lines=True, rotation=0, w
     else:
         downsample_distance = 0
         skip_rate = int(downsample_rate)
+    if window:
+        interpolate = True
+    if interpolate and not downsample_distance:
+        print('Interpolation to station positions requires the downsample rate in meters. Taking every Nth point instead.')
+        interpolate = False
+    if memory and not interpolate:
+        # Only the resampling builds line-sized blocks. Taking single samples already reads one channel at a time.
+        print('The memory budget only applies when resampling (--interp or --window). Ignoring it.')
+        memory = None
     # Open the context like this so you're sure it closes properly afterwards
     with gxpy.gx.GXpy() as gxp:
         gdb = gxpy.gdb.Geosoft_gdb.open(gdb_path)
@@ -255,8 +542,15 @@ def from_gdb(gdb_path, out_path, downsample_rate, skip_lines=True, rotation=0, w
         channels = gdb.list_channels()
         freqs = sorted(set([int(x[4:7]) for x in gdb.list_channels() if (x[:3].upper() in components and x.lower().endswith('hz'))]))
         print('Frequency set is: {}'.format(freqs))
+        if store_file and write_edis:
+            # Write every station to a single indexed site store instead of individual EDIs
+            store = open_store(store_file, freqs)
+            store_names, store_offsets = [], []
         line_skipped = False
         flight_angle = []
+        # Work arrays for the resampling, reused from line to line
+        buffers = {}
+        budget_warned = False
         for il, line in enumerate(lines):
             # Do these one at a time just in case they get returned out of order
             if il > 0 and not line_skipped:
@@ -289,40 +583,47 @@ def from_gdb(gdb_path, out_path, downsample_rate, skip_lines=True, rotation=0, w
                         continue
                     else:
                         line_skipped = False
-                dist = np.sqrt((X[1:] - X[0])**2 + (Y[1:] - Y[0])**2)
-                diff = np.diff(dist % downsample_distance, axis=0)
-                idx = np.where(diff < 0)[0]
+                if interpolate:
+                    # Stations at exact multiples of the downsample distance along the flight path
+                    dist = along_track_distance(X, Y)
+                    stations = np.arange(0, dist[-1], downsample_distance)
+                    if memory and memory < min_memory(len(dist)) and not budget_warned:
+                        print('Warning: Line {} needs at least {:.1f} MB to resample, '
+                              'more than the {:.1f} MB memory budget. The budget will be exceeded on long lines.'.format(
+                                  line, min_memory(len(dist)) / 1024**2, memory / 1024**2))
+                        budget_warned = True
+                else:
+                    dist = np.sqrt((X[1:] - X[0])**2 + (Y[1:] - Y[0])**2)
+                    diff = np.diff(dist % downsample_distance, axis=0)
+                    idx = np.where(diff < 0)[0]
             else:
                 idx = np.arange(0, len(X), skip_rate, dtype=int)
 
-            try:
-                data['Latitude'] = gdb.read_line(line, channels='Latitude')[0][idx]
-                data['Longitude'] = gdb.read_line(line, channels='Longitude')[0][idx]
-            except gxpy.gdb.GdbException:
-                try:
-                    data['Latitude'] = gdb.read_line(line, channels='Lat')[0][idx]
-                    data['Longitude'] = gdb.read_line(line, channels='Long')[0][idx]
-                except gxpy.gdb.GdbException:
-                    data['Latitude'] = gdb.read_line(line, channels='Lat')[0][idx]
-                    data['Longitude'] = gdb.read_line(line, channels='Lon')[0][idx]
-            for key in data.keys():
-                if key not in ('Latitude', 'Longitude'):
-                    data.update({key: np.zeros((len(data['Latitude']), len(freqs)))})
-            for ii, freq in enumerate(freqs):
-                # For some reason it seems to require flipping the real parts
-                # print('XIP_{:03d}Hz'.format(freq))
-                try:
-                    data['TZXR'][:, ii] = np.squeeze(gdb.read_line(line, channels='XIP_{:03d}Hz'.format(freq))[0][idx])
-                    data['TZYR'][:, ii] = np.squeeze(gdb.read_line(line, channels='YIP_{:03d}Hz'.format(freq))[0][idx])
-                    data['TZXI'][:, ii] = np.squeeze(gdb.read_line(line, channels='XQD_{:03d}Hz'.format(freq))[0][idx])
-                    data['TZYI'][:, ii] = np.squeeze(gdb.read_line(line, channels='YQD_{:03d}Hz'.format(freq))[0][idx])
-                except IndexError:
-                    print('IndexError at line {}'.format(line))
-                    print('Infilling frequency {} with dummies'.format(freq))
-                    data['TZXR'][:, ii] = 1e-10
-                    data['TZYR'][:, ii] = 1e-10
-                    data['TZXI'][:, ii] = 1e-10
-                    data['TZYI'][:, ii] = 1e-10
+            if interpolate:
+                data = read_resampled_line(gdb, line, freqs, dist, stations, window=window,
+                                           memory=memory, buffers=buffers)
+            else:
+                lat, lon = read_latlon(gdb, line)
+                data['Latitude'] = lat[idx]
+                data['Longitude'] = lon[idx]
+                for key in data.keys():
+                    if key not in ('Latitude', 'Longitude'):
+                        data.update({key: np.zeros((len(data['Latitude']), len(freqs)))})
+                for ii, freq in enumerate(freqs):
+                    # For some reason it seems to require flipping the real parts
+                    # print('XIP_{:03d}Hz'.format(freq))
+                    try:
+                        data['TZXR'][:, ii] = np.squeeze(gdb.read_line(line, channels='XIP_{:03d}Hz'.format(freq))[0][idx])
+                        data['TZYR'][:, ii] = np.squeeze(gdb.read_line(line, channels='YIP_{:03d}Hz'.format(freq))[0][idx])
+                        data['TZXI'][:, ii] = np.squeeze(gdb.read_line(line, channels='XQD_{:03d}Hz'.format(freq))[0][idx])
+                        data['TZYI'][:, ii] = np.squeeze(gdb.read_line(line, channels='YQD_{:03d}Hz'.format(freq))[0][idx])
+                    except IndexError:
+                        print('IndexError at line {}'.format(line))
+                        print('Infilling frequency {} with dummies'.format(freq))
+                        data['TZXR'][:, ii] = 1e-10
+                        data['TZYR'][:, ii] = 1e-10
+                        data['TZXI'][:, ii] = 1e-10
+                        data['TZYI'][:, ii] = 1e-10
             
             if rotation:
                 if use_line_angle:
@@ -331,6 +632,19 @@ def from_gdb(gdb_path, out_path, downsample_rate, skip_lines=True, rotation=0, w
                     rotation_angle = rotation
                 data = rotate_data(data, theta=rotation_angle)
             
+            if store_file:
+                site_names = ['{}_{:03d}'.format(line, ii) for ii in range(len(data['TZXR'][:,0]))]
+                records = store_records(site_names, len(freqs))
+                records['TZXR'] = -1*data['TZYR']
+                records['TZYR'] = -1*data['TZXR']
+                records['TZXI'] = data['TZYI']
+                records['TZYI'] = data['TZXI']
+                records['Latitude'] = data['Latitude'][:, 0]
+                records['Longitude'] = data['Longitude'][:, 0]
+                store_names.extend(site_names)
+                store_offsets.append(write_store(store, records))
+                continue
+
             for ii in range(len(data['TZXR'][:,0])):
                 site_name = '{}_{:03d}'.format(line, ii)
                 out_file = out_path + site_name + '.edi'
@@ -345,6 +659,9 @@ def from_gdb(gdb_path, out_path, downsample_rate, skip_lines=True, rotation=0, w
                 if not os.path.exists(out_path):
                     os.mkdir(out_path)
                 to_edi(site, out_file, freqs=freqs, info=None, header=None, mtsect=None, defs=None)
+        if store_file and write_edis:
+            close_store(store, freqs, store_names, np.concatenate(store_offsets) if store_offsets else [])
+            print('Wrote {} sites to {}'.format(len(store_names), store_file))
         print('Flight angle min: {:>4.2f}, max: {:>4.2f}, mean: {:>4.2f}'.format(np.nanmin(flight_angle),
                                                                                  np.nanmax(flight_angle),
                                                                                  np.nanmean(flight_angle)))
@@ -405,15 +722,76 @@ def from_grd(data_path, out_path, downsample_rate):
         out_file = os.path.join(out_path, site_name + '.edi')
         to_edi(site, out_file, freqs=freqs, info=None, header=None, mtsect=None, defs=None)
 
+def usage():
+    print('Usage is:\n')
+    print('\t ztem2edi <path/to/.gdb> <output_path> <downsample_rate | Default=1000m> <rotation_angle | Default=0>\n')
+    print('\t ztem2edi <path/to/.ztem> <output_path> <site names | Default=all>\n')
+    print('Give an output path ending in .ztem to write all stations to a single indexed site store instead of individual EDIs\n')
+    print('EDIs can then be rendered from the site store as needed, e.g., ztem2edi sites.ztem edis/ L1010_* L1020_005\n')
+    print('Specify downsample rate as, e.g., 1000m to search for points at a 1000 meter separation\n')
+    print('If the "m" is omitted, every nth point will be taken instead\n')
+    print('Add --interp to interpolate all channels to stations at exactly the downsample distance along each flight line\n')
+    print('Add --window=<N>m to average over an N meter window around each station (implies --interp)\n')
+    print('Add --memory=<N>MB (or KB / GB) to resample long lines in chunks that stay within that memory budget\n')
+    print('Enter a string (e.g., "test") in place of the rotation angle to check the flight line orientation without writing the EDIs\n')
+    print('Be sure to check if any rotation is necessary (i.e., are X and Y oriented towards E-W / N-S, or towards flight directions?)')
+    print('Meter designation not available for .grd files\n')
+    print('Frequency search within .gdb files assumes channels are listed as <component>_<freq>Hz\n')
+    # print('Frequency search within .grd files assumes files named as <tag>_<component>_<freq>Hz.grd\n')
+    # Not sure if the orientation is actually contained within the gdb or grd files, or if needs to be guessed
+    # from the flight path (i.e., assume the orientation is parallel to the flight path)
+    # print('Note: The only data processing that occurs is a flip of the real components - ' +
+          # 'otherwise the input ZTEM data is assumed to be oriented with the X-component to the north.edi\n')
+    print('If possible check the output EDIs against co-located MT data and/or power lines.')
+
+
 def main():
+    # Optional flags, e.g., --interp or --window=250m, may be given anywhere on the command line
+    options = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    args = [arg for arg in sys.argv if not arg.startswith('--')]
+    interpolate = '--interp' in options
+    window = 0
+    memory = None
+    bad_options = []
+    for option in options:
+        if option.startswith('--window='):
+            try:
+                window = float(option[len('--window='):].rstrip('mM'))
+            except ValueError:
+                bad_options.append(option)
+                continue
+            if not np.isfinite(window) or window < 0:
+                bad_options.append(option)
+        elif option.startswith('--memory='):
+            # Memory budget in MB, unless given with a KB, MB or GB suffix
+            value = option[len('--memory='):].upper()
+            scale = 1024**2
+            for suffix, suffix_scale in (('KB', 1024), ('MB', 1024**2), ('GB', 1024**3)):
+                if value.endswith(suffix):
+                    value, scale = value[:-len(suffix)], suffix_scale
+                    break
+            try:
+                memory = float(value) * scale
+            except ValueError:
+                bad_options.append(option)
+                continue
+            if not np.isfinite(memory) or memory <= 0:
+                bad_options.append(option)
+    if bad_options:
+        print('Could not read option(s): {}\n'.format(' '.join(bad_options)))
+        usage()
+        return
     try:
+        if args[1].endswith('.ztem'):
+            from_store(store_file=args[1], out_path=args[2], site_names=args[3:])
+            return
         try:
-            downsample_rate = sys.argv[3]
+            downsample_rate = args[3]
             try:
-                rotation = float(sys.argv[4])
+                rotation = float(args[4])
                 write_edis = True
             except ValueError:
-                if sys.argv[4] == '-i':
+                if args[4] == '-i':
                     rotation = '-i'
                     write_edis = True
                 else:                    
@@ -423,31 +801,20 @@ def main():
         except IndexError:
             downsample_rate = '1000m'
             rotation = 0
-        if sys.argv[1].endswith('.gdb'):
-            from_gdb(gdb_path=sys.argv[1], out_path=sys.argv[2],
+        if args[1].endswith('.gdb'):
+            store_file = args[2] if args[2].endswith('.ztem') else None
+            from_gdb(gdb_path=args[1], out_path=args[2],
                      downsample_rate=str(downsample_rate),
-                     rotation=rotation, write_edis=write_edis)
+                     rotation=rotation, write_edis=write_edis, store_file=store_file,
+                     interpolate=interpolate, window=window, memory=memory)
             return
-        elif sys.argv[1].endswith('.grd'):
-            # from_grd(gdb_path=sys.argv[1], out_path=sys.argv[2], downsample_rate=str(downsample_rate))
+        elif args[1].endswith('.grd'):
+            # from_grd(gdb_path=args[1], out_path=args[2], downsample_rate=str(downsample_rate))
             # return
             print('Conversion from .grd files is depreciated (for now). Please use a .gdb file instead\n')
     except IndexError:
         print(IndexError.msg)
-    print('Usage is:\n')
-    print('\t ztem2edi <path/to/.gdb> <output_path> <downsample_rate | Default=1000m> <rotation_angle | Default=0>\n')
-    print('Specify downsample rate as, e.g., 1000m to search for points at a 1000 meter separation\n')
-    print('If the "m" is omitted, every nth point will be taken instead\n')
-    print('Enter a string (e.g., "test") in place of the rotation angle to check the flight line orientation without writing the EDIs\n')
-    print('Be sure to check if any rotation is necessary (i.e., are X and Y oriented towards E-W / N-S, or towards flight directions?)')
-    print('Meter designation not available for .grd files\n')
-    print('Frequency search within .gdb files assumes channels are listed as <component>_<freq>Hz\n')
-    # print('Frequency search within .grd files assumes files named as <tag>_<component>_<freq>Hz.grd\n')
-    # Not sure if the orientation is actually contained within the gdb or grd files, or if needs to be guessed
-    # from the flight path (i.e., assume the orientation is parallel to the flight path)
-    # print('Note: The only data processing that occurs is a flip of the real components - ' +
-          # 'otherwise the input ZTEM data is assumed to be oriented with the X-component to the north.edi\n')
-    print('If possible check the output EDIs against co-located MT data and/or power lines.')
+    usage()
 
 
 if __name__ == '__main__':